@@ -1,16 +1,78 @@
 # adapters/urbania.py
 import asyncio
+import logging
 import re
 import unicodedata
-from typing import List, Dict, Any
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Tuple, Union
 
 import httpx
-from bs4 import BeautifulSoup
+from cachetools import TTLCache
+from selectolax.lexbor import LexborHTMLParser
 
+logger = logging.getLogger(__name__)
 
+_DIGITS_RE = re.compile(r"\d+")
+_PRICE_HINT_RE = re.compile(r"\$|US|S/")
+_SLUG_RE = re.compile(r"[^a-z0-9]+")
+# Borra todo lo que no sea dígito ASCII (Latin-1) en una sola pasada de str.translate
+_PRICE_DIGITS = str.maketrans("", "", "".join(chr(c) for c in range(256) if not "0" <= chr(c) <= "9"))
+
+# Cascadas en orden de prioridad: gana el primer selector que encuentra algo.
+# No se combinan en un solo "A, B": Lexbor devuelve un nodo por cada selector que
+# calce (tarjetas duplicadas) y css_first tomaría el primero en orden de documento.
+_CARD_SELECTORS = (
+    "div.posting-card",
+    "div.ui-posting-card",
+    "article.posting-card",
+    "article[data-id]",
+    "li.posting-card",
+    "[data-testid='posting-card']",
+)
+_TITLE_SELECTORS = (".posting-title", "h2", "h3", "[data-testid='posting-title']")
+_PRICE_SELECTORS = (".first-price", ".posting-price", "[data-testid='price']")
+
+@dataclass(slots=True)
+class Listing:
+    """Aviso normalizado (más liviano que un dict por tarjeta)."""
+    titulo: str
+    precio: int
+    moneda: str
+    distrito: str
+    url_aviso: str
+    fuente: str = "urbania"
+
+
+# Resultados parseados por (operacion, distrito, params); evita repetir el scrape en reintentos
+_CacheKey = Tuple[str, str, Tuple[Tuple[str, str], ...]]
+_CACHE: "TTLCache[_CacheKey, List[Listing]]" = TTLCache(maxsize=512, ttl=180)
+# Un lock por clave para que búsquedas idénticas concurrentes hagan un solo request (single-flight)
+_LOCKS: Dict[_CacheKey, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
+def _precio_int(txt: str) -> int:
+    cleaned = txt.translate(_PRICE_DIGITS)
+    if cleaned.isdecimal():
+        return int(cleaned)
+    # Quedaron caracteres fuera de Latin-1: caemos al regex
+    nums = _DIGITS_RE.findall(cleaned)
+    return int("".join(nums)) if nums else 0
+
+
+def _first(node, selectors: Tuple[str, ...]):
+    for sel in selectors:
+        el = node.css_first(sel)
+        if el is not None:
+            return el
+    return None
+
+
+@lru_cache(maxsize=256)
 def _slug(s: str) -> str:
     s = unicodedata.normalize("NFD", s).encode("ascii", "ignore").decode("utf-8")
-    return re.sub(r"[^a-z0-9]+", "-", s.lower()).strip("-")
+    return _SLUG_RE.sub("-", s.lower()).strip("-")
 
 
 class UrbaniaAdapter:
@@ -55,6 +117,29 @@ class UrbaniaAdapter:
         "Connection": "keep-alive",
     }
 
+    # Cliente compartido entre llamadas: reutiliza conexiones, TLS y el stream HTTP/2
+    _client: Optional[httpx.AsyncClient] = None
+    _warmed: bool = False
+
+    @classmethod
+    def _get_client(cls) -> httpx.AsyncClient:
+        if cls._client is None:
+            # http2=True requiere lib h2 (opcional)
+            cls._client = httpx.AsyncClient(
+                timeout=40.0,
+                headers=cls.BASE_HEADERS,
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=85.0),
+            )
+        return cls._client
+
+    @classmethod
+    async def aclose(cls) -> None:
+        if cls._client is not None:
+            await cls._client.aclose()
+            cls._client = None
+            cls._warmed = False
+
     def _build_urls(self, operacion: str, distrito: str) -> List[str]:
         slug_d = _slug(distrito)
         return [p.format(operacion=operacion, slug=slug_d) for p in self.ROUTE_PATTERNS]
@@ -81,73 +166,63 @@ class UrbaniaAdapter:
 
         return p
 
-    def _parse_cards(self, html: str, distrito: str) -> List[Dict[str, Any]]:
-        soup = BeautifulSoup(html, "html.parser")
-
-        candidates = []
-        for sel in [
-            "div.posting-card",
-            "div.ui-posting-card",
-            "article.posting-card",
-            "article[data-id]",
-            "li.posting-card",
-            "[data-testid='posting-card']",
-        ]:
-            found = soup.select(sel)
-            if found:
-                candidates = found
-                break
-
-        results: List[Dict[str, Any]] = []
+    def _parse_cards(
+        self, html: Union[str, bytes], distrito: str, precio_tope: Optional[int] = None, moneda_buscada: Optional[str] = None
+    ) -> Tuple[int, List[Listing]]:
+        """(tarjetas en la página, avisos dentro del tope). Una página con tarjetas pero todas
+        fuera de presupuesto es un acierto vacío, no "sin tarjetas"."""
+        tree = LexborHTMLParser(html)
+
+        candidates = next((found for sel in _CARD_SELECTORS if (found := tree.css(sel))), [])
+
+        distrito_t = distrito.title()
+        results: List[Listing] = []
         for c in candidates:
             try:
-                title_el = (
-                    c.select_one(".posting-title")
-                    or c.select_one("h2")
-                    or c.select_one("h3")
-                    or c.select_one("[data-testid='posting-title']")
-                )
-                titulo = title_el.get_text(strip=True) if title_el else "(sin título)"
-
                 price_el = (
-                    c.select_one(".first-price")
-                    or c.select_one(".posting-price")
-                    or c.select_one("[data-testid='price']")
-                    or c.find("span", string=re.compile(r"\$|US|S/"))
+                    _first(c, _PRICE_SELECTORS)
+                    or next((sp for sp in c.css("span") if _PRICE_HINT_RE.search(sp.text())), None)
                 )
-                precio_txt = price_el.get_text(" ", strip=True) if price_el else ""
-                nums = re.findall(r"\d+", precio_txt.replace(".", "").replace(",", ""))
-                precio_num = int("".join(nums)) if nums else 0
+                precio_txt = price_el.text(separator=" ", strip=True) if price_el else ""
+                precio_num = _precio_int(precio_txt)
                 moneda = "USD" if any(x in precio_txt.upper() for x in ["US$", "USD", "$"]) and "S/" not in precio_txt else "PEN"
+                # fuera del rango pedido: ni siquiera armamos el aviso
+                if precio_tope and moneda == moneda_buscada and precio_num > precio_tope:
+                    continue
+
+                title_el = _first(c, _TITLE_SELECTORS)
+                titulo = title_el.text(strip=True) if title_el else "(sin título)"
 
-                link = c.select_one("a[href*='/inmueble/'], a.go-to-posting, a[href*='/propiedad/']")
-                href = link["href"] if link and link.has_attr("href") else ""
+                link = c.css_first("a[href*='/inmueble/'], a.go-to-posting, a[href*='/propiedad/']")
+                href = (link.attributes.get("href") or "") if link else ""
                 if href and href.startswith("/"):
                     url_aviso = f"https://urbania.pe{href}"
                 else:
                     url_aviso = href or ""
 
-                results.append({
-                    "titulo": titulo,
-                    "precio": precio_num,
-                    "moneda": moneda,
-                    "distrito": distrito.title(),
-                    "url_aviso": url_aviso,
-                    "fuente": "urbania",
-                })
+                results.append(Listing(
+                    titulo=titulo,
+                    precio=precio_num,
+                    moneda=moneda,
+                    distrito=distrito_t,
+                    url_aviso=url_aviso,
+                ))
             except Exception as e:
-                print(f"[Urbania] Error parseando tarjeta: {e}")
-        return results
+                logger.warning("[Urbania] Error parseando tarjeta: %s", e)
+        return len(candidates), results
 
-    async def _warmup(self, client: httpx.AsyncClient) -> None:
+    async def _warmup(self, client: httpx.AsyncClient) -> bool:
         try:
             r = await client.get(self.HOME)
             if r.status_code != 200:
-                print(f"[Urbania] Warm-up status={r.status_code}")
+                logger.warning("[Urbania] Warm-up status=%s", r.status_code)
+                return False
+            return True
         except Exception as e:
-            print(f"[Urbania] Warm-up error: {e}")
+            logger.warning("[Urbania] Warm-up error: %s", e)
+            return False
 
-    async def buscar(self, consulta: Dict[str, Any]) -> List[Dict[str, Any]]:
+    async def buscar(self, consulta: Dict[str, Any]) -> List[Listing]:
         distritos = consulta.get("distritos") or []
         operacion = (consulta.get("operacion") or "venta").lower()
         if operacion not in ("venta", "alquiler"):
@@ -156,42 +231,76 @@ class UrbaniaAdapter:
             return []
 
         params = self._build_params(consulta)
-        out: List[Dict[str, Any]] = []
-
-        # http2=True requiere lib h2 (opcional)
-        async with httpx.AsyncClient(
-            timeout=40.0,
-            headers=self.BASE_HEADERS,
-            http2=True,
-        ) as client:
-            # 1) warm-up para obtener cookies y consent
-            await self._warmup(client)
-
-            # 2) iterar distritos
-            for distrito in distritos:
+        out: List[Listing] = []
+
+        client = self._get_client()
+
+        # 1) warm-up para obtener cookies y consent (quedan en el cliente compartido);
+        #    solo se marca hecho con un 200, si falla se reintenta en la próxima búsqueda
+        if not UrbaniaAdapter._warmed:
+            UrbaniaAdapter._warmed = await self._warmup(client)
+
+        # 2) distritos en paralelo (acotado); dentro de cada uno, patrones de URL en orden
+        sem = asyncio.BoundedSemaphore(8)
+        params_key = tuple(sorted(params.items()))
+        # mismo tope (+20%) y moneda que se envían a Urbania, para descartar tarjetas de más
+        precio_tope = int(params["precioMax"]) if "precioMax" in params else None
+        moneda_buscada = "USD" if params["moneda"] == "dolares" else "PEN"
+
+        async def scrape(distrito: str) -> Optional[List[Listing]]:
+            """None si ningún patrón devolvió tarjetas; si no, los avisos (quizá ninguno) tras el tope."""
+            async with sem:
                 urls = self._build_urls(operacion, distrito)
-                got = []
+                got: Optional[List[Listing]] = None
 
-                for i, url in enumerate(urls):
+                for url in urls:
                     try:
                         r = await client.get(url, params=params)
                         if r.status_code != 200:
-                            print(f"[Urbania] {r.status_code} - {url}")
+                            logger.warning("[Urbania] %s - %s", r.status_code, url)
                             # pequeño backoff y reintento simple para el siguiente patrón
                             await asyncio.sleep(0.8)
                             continue
 
-                        parsed = self._parse_cards(r.text, distrito)
-                        if parsed:
+                        # bytes crudos: Lexbor decodifica UTF-8 por su cuenta, sin la copia str de r.text
+                        n_cards, parsed = self._parse_cards(r.content, distrito, precio_tope, moneda_buscada)
+                        if n_cards:
                             got = parsed
                             break
                     except Exception as e:
-                        print(f"[Urbania] Error request {url}: {e}")
+                        logger.warning("[Urbania] Error request %s: %s", url, e)
                         await asyncio.sleep(0.8)
 
-                if not got:
-                    print(f"[Urbania] 0 resultados para distrito={distrito} urls={urls}")
-                out.extend(got)
+                if got is None:
+                    logger.info("[Urbania] 0 resultados para distrito=%s urls=%s", distrito, urls)
+                return got
+
+        async def fetch_one(distrito: str) -> List[Listing]:
+            key = (operacion, distrito, params_key)
+            cached = _CACHE.get(key)
+            if cached is not None:
+                return cached
+
+            lock = _LOCKS[key]
+            async with lock:
+                cached = _CACHE.get(key)
+                if cached is None:
+                    got = await scrape(distrito)
+                    # cacheamos toda página con tarjetas (aunque el tope deje 0 avisos);
+                    # un 403/sin tarjetas se reintenta en la próxima búsqueda
+                    if got is not None:
+                        _CACHE[key] = got
+                    cached = got or []
+            if not lock.locked():
+                _LOCKS.pop(key, None)
+            return cached
+
+        lists = await asyncio.gather(*(fetch_one(d) for d in distritos), return_exceptions=True)
+        for distrito, got in zip(distritos, lists):
+            if isinstance(got, BaseException):
+                logger.error("[Urbania] Error distrito=%s: %s", distrito, got)
+                continue
+            out.extend(got)
 
-        print(f"[Urbania] Total encontrados: {len(out)}")
+        logger.info("[Urbania] Total encontrados: %d", len(out))
         return out
@@ -1,13 +1,42 @@
 
 # adapters/urbania_playwright.py
-import re, unicodedata, asyncio
-from typing import List, Dict, Any
-from bs4 import BeautifulSoup
-from playwright.async_api import async_playwright
+import asyncio, logging
+from typing import List, Dict, Any, Optional
+from adapters.urbania import Listing, _CARD_SELECTORS, _precio_int, _slug
+from playwright.async_api import (
+    async_playwright, Playwright, Browser, BrowserContext, Route, TimeoutError as PlaywrightTimeoutError,
+)
+
+logger = logging.getLogger(__name__)
+
+# Solo para esperar a que haya alguna tarjeta en el DOM
+_CARD_SELECTOR = ", ".join(_CARD_SELECTORS)
+# Extracción dentro del navegador: por CDP solo viaja un JSON pequeño, no el DOM serializado.
+# Tarjetas con la misma cascada que UrbaniaAdapter; título y precio también por prioridad
+# (querySelector("A, B") tomaría el primero en orden de documento).
+_EXTRACT_JS = """(sels) => {
+    const pick = (c, ss) => {
+        for (const s of ss) { const el = c.querySelector(s); if (el) return el; }
+        return null;
+    };
+    let cards = [];
+    for (const s of sels) { cards = document.querySelectorAll(s); if (cards.length) break; }
+    return Array.from(cards, c => ({
+        titulo: (pick(c, ['.posting-title', 'h2', 'h3'])?.innerText || '').trim(),
+        precio: (pick(c, ['.first-price', '.posting-price'])?.innerText || '').trim(),
+        href: c.querySelector("a[href*='/inmueble/'], a.go-to-posting, a[href*='/propiedad/']")?.getAttribute('href') || '',
+    }));
+}"""
+# Solo necesitamos el HTML del listado: imágenes, fuentes, CSS, video, etc. son peso muerto
+_BLOCKED_RESOURCES = {"image", "media", "font", "stylesheet", "other"}
+
+
+async def _block_assets(route: Route) -> None:
+    if route.request.resource_type in _BLOCKED_RESOURCES:
+        await route.abort()
+    else:
+        await route.continue_()
 
-def _slug(s: str) -> str:
-    s = unicodedata.normalize("NFD", s).encode("ascii", "ignore").decode("utf-8")
-    return re.sub(r"[^a-z0-9]+", "-", s.lower()).strip("-")
 
 class UrbaniaPlayAdapter:
     """
@@ -21,6 +50,90 @@ class UrbaniaPlayAdapter:
         "https://urbania.pe/buscar/{operacion}-de-departamentos-en-{slug}",
     ]
 
+    # Un solo Chromium + context por proceso: lanzar el navegador cuesta ~0.5 s y ~150 MB por búsqueda
+    _pw: Optional[Playwright] = None
+    _browser: Optional[Browser] = None
+    _context: Optional[BrowserContext] = None
+    _warmed: bool = False
+    _start_lock = asyncio.Lock()
+
+    @classmethod
+    async def start(cls) -> BrowserContext:
+        async with cls._start_lock:
+            if cls._context is None:
+                if cls._pw is None:
+                    cls._pw = await async_playwright().start()
+                browser: Optional[Browser] = None
+                try:
+                    browser = await cls._pw.chromium.launch(headless=True, args=["--no-sandbox"])
+                    context = await browser.new_context(locale="es-PE")
+                    await context.route("**/*", _block_assets)
+                except Exception:
+                    # arranque a medias: no dejar vivos navegador ni driver
+                    if browser is not None:
+                        await browser.close()
+                    await cls._pw.stop()
+                    cls._pw = None
+                    raise
+                # si Chromium se cae, el próximo start() relanza en vez de reusar un context muerto
+                browser.on("disconnected", cls._on_disconnected)
+                cls._browser, cls._context, cls._warmed = browser, context, False
+
+            # Warm-up (home) para consent/cookies; las cookies quedan en el context.
+            # Solo se da por hecho si salió bien: si falla se reintenta en la próxima búsqueda.
+            if not cls._warmed:
+                cls._warmed = await cls._warmup(cls._context)
+            return cls._context
+
+    @classmethod
+    async def _warmup(cls, context: BrowserContext) -> bool:
+        page = None
+        try:
+            page = await context.new_page()
+            await page.goto("https://urbania.pe/", wait_until="domcontentloaded", timeout=30000)
+            return True
+        except Exception as e:
+            # context muerto incluido: buscar() lo descarta al fallar new_page()
+            logger.warning("[UrbaniaPW] warm-up error: %s", e)
+            return False
+        finally:
+            if page is not None:
+                await page.close()
+
+    @classmethod
+    def _on_disconnected(cls, browser: Browser) -> None:
+        if cls._browser is browser:
+            logger.warning("[UrbaniaPW] navegador desconectado; se relanza en la próxima búsqueda")
+            cls._browser = cls._context = None
+            cls._warmed = False
+
+    @classmethod
+    async def _invalidate(cls, context: BrowserContext) -> None:
+        """Descarta un context que ya no abre páginas (p. ej. navegador colgado)."""
+        async with cls._start_lock:
+            if cls._context is not context:
+                return  # otra tarea ya lo reemplazó
+            browser = cls._browser
+            cls._browser = cls._context = None
+            cls._warmed = False
+            if browser is not None:
+                try:
+                    await browser.close()
+                except Exception as e:
+                    logger.warning("[UrbaniaPW] error cerrando navegador: %s", e)
+
+    @classmethod
+    async def stop(cls) -> None:
+        async with cls._start_lock:
+            if cls._context is not None:
+                await cls._context.close()
+            if cls._browser is not None:
+                await cls._browser.close()
+            if cls._pw is not None:
+                await cls._pw.stop()
+            cls._pw = cls._browser = cls._context = None
+            cls._warmed = False
+
     def _build_urls(self, operacion: str, distrito: str) -> List[str]:
         slug = _slug(distrito)
         return [r.format(operacion=operacion, slug=slug) for r in self.ROUTES]
@@ -44,44 +157,37 @@ class UrbaniaPlayAdapter:
                 pass
         return q
 
-    def _parse_cards(self, html: str, distrito: str) -> List[Dict[str, Any]]:
-        soup = BeautifulSoup(html, "html.parser")
-        candidates = []
-        for sel in [
-            "div.posting-card", "div.ui-posting-card", "article.posting-card",
-            "article[data-id]", "li.posting-card", "[data-testid='posting-card']",
-        ]:
-            found = soup.select(sel)
-            if found:
-                candidates = found
-                break
-
-        out: List[Dict[str, Any]] = []
-        for c in candidates:
+    def _parse_cards(
+        self,
+        cards: List[Dict[str, str]],
+        distrito: str,
+        precio_tope: Optional[int] = None,
+        moneda_buscada: Optional[str] = None,
+    ) -> List[Listing]:
+        distrito_t = distrito.title()
+        out: List[Listing] = []
+        for c in cards:
             try:
-                title_el = c.select_one(".posting-title") or c.select_one("h2") or c.select_one("h3")
-                titulo = title_el.get_text(strip=True) if title_el else "(sin título)"
-                price_el = c.select_one(".first-price") or c.select_one(".posting-price")
-                precio_txt = price_el.get_text(" ", strip=True) if price_el else ""
-                nums = re.findall(r"\d+", precio_txt.replace(".", "").replace(",", ""))
-                precio_num = int("".join(nums)) if nums else 0
+                precio_txt = c.get("precio") or ""
+                precio_num = _precio_int(precio_txt)
                 moneda = "USD" if any(x in precio_txt.upper() for x in ["US$", "USD", "$"]) and "S/" not in precio_txt else "PEN"
-                link = c.select_one("a[href*='/inmueble/'], a.go-to-posting, a[href*='/propiedad/']")
-                href = link.get("href") if link else ""
+                if precio_tope and moneda == moneda_buscada and precio_num > precio_tope:
+                    continue
+                titulo = c.get("titulo") or "(sin título)"
+                href = c.get("href") or ""
                 url_aviso = f"https://urbania.pe{href}" if href.startswith("/") else href
-                out.append({
-                    "titulo": titulo,
-                    "precio": precio_num,
-                    "moneda": moneda,
-                    "distrito": distrito.title(),
-                    "url_aviso": url_aviso,
-                    "fuente": "urbania",
-                })
+                out.append(Listing(
+                    titulo=titulo,
+                    precio=precio_num,
+                    moneda=moneda,
+                    distrito=distrito_t,
+                    url_aviso=url_aviso,
+                ))
             except Exception as e:
-                print(f"[UrbaniaPW] parse error: {e}")
+                logger.warning("[UrbaniaPW] parse error: %s", e)
         return out
 
-    async def buscar(self, consulta: Dict[str, Any]) -> List[Dict[str, Any]]:
+    async def buscar(self, consulta: Dict[str, Any]) -> List[Listing]:
         distritos = consulta.get("distritos") or []
         operacion = (consulta.get("operacion") or "venta").lower()
         if operacion not in ("venta", "alquiler"):
@@ -90,49 +196,62 @@ class UrbaniaPlayAdapter:
             return []
 
         query = self._build_query(consulta)
-        out: List[Dict[str, Any]] = []
+        precio_tope = int(query["precioMax"]) if "precioMax" in query else None
+        moneda_buscada = "USD" if query["moneda"] == "dolares" else "PEN"
+        out: List[Listing] = []
 
-        async with async_playwright() as pw:
-            browser = await pw.chromium.launch(headless=True, args=["--no-sandbox"])
-            context = await browser.new_context(locale="es-PE")
-            page = await context.new_page()
+        context = await self.start()
 
-            # Warm-up (home) para consent/cookies
-            try:
-                await page.goto("https://urbania.pe/", wait_until="domcontentloaded", timeout=30000)
-            except Exception as e:
-                print(f"[UrbaniaPW] warm-up error: {e}")
+        # Distritos en paralelo, pocas páginas a la vez (cada una es pesada)
+        sem = asyncio.BoundedSemaphore(2)
 
-            for distrito in distritos:
+        async def fetch_one(distrito: str) -> List[Listing]:
+            async with sem:
                 urls = self._build_urls(operacion, distrito)
-                got = []
-                for url in urls:
-                    try:
-                        # Construir URL con parámetros
-                        if query:
-                            q = "&".join([f"{k}={v}" for k, v in query.items()])
-                            final_url = f"{url}?{q}"
-                        else:
-                            final_url = url
-
-                        await page.goto(final_url, wait_until="domcontentloaded", timeout=45000)
-                        # pequeña espera para que cargue listado
-                        await page.wait_for_timeout(1200)
-                        html = await page.content()
-                        parsed = self._parse_cards(html, distrito)
-                        if parsed:
-                            got = parsed
-                            break
-                    except Exception as e:
-                        print(f"[UrbaniaPW] nav error {url}: {e}")
-                        await page.wait_for_timeout(800)
+                got: List[Listing] = []
+                try:
+                    page = await context.new_page()
+                except Exception:
+                    await self._invalidate(context)
+                    raise
+                try:
+                    for url in urls:
+                        try:
+                            # Construir URL con parámetros
+                            if query:
+                                q = "&".join([f"{k}={v}" for k, v in query.items()])
+                                final_url = f"{url}?{q}"
+                            else:
+                                final_url = url
+
+                            await page.goto(final_url, wait_until="domcontentloaded", timeout=45000)
+                            # seguimos apenas el listado está en el DOM
+                            try:
+                                await page.wait_for_selector(_CARD_SELECTOR, timeout=8000)
+                            except PlaywrightTimeoutError:
+                                logger.info("[UrbaniaPW] sin tarjetas %s", url)
+                                continue
+                            cards = await page.evaluate(_EXTRACT_JS, list(_CARD_SELECTORS))
+                            # la página tenía tarjetas: paramos aquí aunque el tope las descarte todas
+                            if cards:
+                                got = self._parse_cards(cards, distrito, precio_tope, moneda_buscada)
+                                break
+                        except Exception as e:
+                            logger.warning("[UrbaniaPW] nav error %s: %s", url, e)
+                            await page.wait_for_timeout(800)
+                finally:
+                    await page.close()
 
                 if not got:
-                    print(f"[UrbaniaPW] 0 resultados distrito={distrito} urls={urls}")
-                out.extend(got)
+                    logger.info("[UrbaniaPW] 0 resultados distrito=%s urls=%s", distrito, urls)
+                return got
 
-            await context.close()
-            await browser.close()
+        lists = await asyncio.gather(*(fetch_one(d) for d in distritos), return_exceptions=True)
+        for distrito, got in zip(distritos, lists):
+            if isinstance(got, BaseException):
+                logger.error("[UrbaniaPW] error distrito=%s: %s", distrito, got)
+                continue
+            out.extend(got)
 
-        print(f"[UrbaniaPW] total={len(out)}")
+        logger.info("[UrbaniaPW] total=%d", len(out))
         return out
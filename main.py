@@ -1,11 +1,30 @@
 
 # main.py
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse
+import asyncio
+import logging
+import logging.handlers
 import os
+import queue
+from dataclasses import asdict
 import httpx
+import orjson
 from adapters.urbania import UrbaniaAdapter
+from adapters.urbania_playwright import UrbaniaPlayAdapter
+from nocodb_client import noco_aclose
+
+# Logs vía cola: el event loop solo encola; un hilo aparte escribe en stdout
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))  # el formato real lo aplica _log_handler
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
+logger = logging.getLogger(__name__)
 
-app = FastAPI(title="MK Finder MVP")
+app = FastAPI(title="MK Finder MVP", default_response_class=ORJSONResponse)
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
@@ -16,11 +35,27 @@ def health():
         "service": "MK Finder MVP",
         "telegram": bool(TELEGRAM_BOT_TOKEN)
     }
-from adapters.urbania_playwright import UrbaniaPlayAdapter
+
+
+@app.on_event("startup")
+async def startup():
+    _log_listener.start()
+    # Una sola instancia por proceso; el navegador/cliente HTTP viven en la clase
+    app.state.urbania = UrbaniaPlayAdapter()
+    # Tope de scrapes simultáneos para no gatillar 429/throttling de Urbania en ráfagas
+    app.state.urbania_sem = asyncio.Semaphore(int(os.getenv("URBANIA_CONCURRENCY", "8")))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await UrbaniaAdapter.aclose()
+    await UrbaniaPlayAdapter.stop()
+    await noco_aclose()
+    _log_listener.stop()
+
 
 @app.get("/test/urbania")
 async def test_urbania():
-    adapter = UrbaniaPlayAdapter()
     consulta = {
         "operacion": "venta",        # o "alquiler"
         "distritos": ["miraflores"],
@@ -28,18 +63,31 @@ async def test_urbania():
         "precio_max": 250000,
         "moneda": "USD"              # o "PEN"
     }
-    res = await adapter.buscar(consulta)
-    return {"count": len(res), "sample": res[:5]}
+    async with app.state.urbania_sem:
+        res = await app.state.urbania.buscar(consulta)
+    return {"count": len(res), "sample": [asdict(x) for x in res[:5]]}
 
 
 # Webhook de Telegram (solo placeholder para probar)
+# Respuesta ya serializada y reutilizada en cada update
+_OK = Response(content=b'{"ok":true}', media_type="application/json")
+
+
 @app.post("/bot/telegram/webhook")
 async def telegram_webhook(request: Request):
-    payload = await request.json()
-    print("📩 Mensaje recibido de Telegram:", payload)
-    return {"ok": True}
+    payload = orjson.loads(await request.body())
+    logger.info("📩 Mensaje recibido de Telegram: %s", payload)
+    return _OK
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=False)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        reload=False,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "2")),
+    )
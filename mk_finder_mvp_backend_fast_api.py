@@ -8,7 +8,7 @@ Qué incluye este MVP (listo para ejecutar):
 
 Cómo ejecutar localmente:
 - Python 3.10+
-- pip install fastapi uvicorn pydantic
+- pip install fastapi uvicorn pydantic cachetools
 - Guardar este archivo como main.py
 - Ejecutar: uvicorn main:app --reload --port 8000
 
@@ -22,11 +22,17 @@ Notas:
 - Dataset: mock en memoria; luego conectaremos Urbania/Properati.
 """
 from typing import List, Optional, Dict, Any
+import heapq
+import os
+from dataclasses import dataclass, field, fields
+import threading
+from cachetools import LRUCache, cached
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 import re
 
-app = FastAPI(title="MK Finder MVP", version="0.1.0")
+app = FastAPI(title="MK Finder MVP", version="0.1.0", default_response_class=ORJSONResponse)
 
 # -----------------------------
 # 1) Catálogo de distritos (base)
@@ -116,9 +122,34 @@ class ConsultaEstructurada(BaseModel):
     amoblado: Optional[bool] = None
     pet_friendly: Optional[bool] = None
 
+@dataclass(slots=True)
+class _ConsultaRaw:
+    """Mismos campos que ConsultaEstructurada, sin validación: el parser llena este y al final
+    se arma el modelo Pydantic una sola vez."""
+    operacion: Optional[str] = None
+    distritos: List[str] = field(default_factory=list)
+    tipo: Optional[List[str]] = None
+    precio_min: Optional[float] = None
+    precio_max: Optional[float] = None
+    moneda: Optional[str] = None
+    area_min_m2: Optional[float] = None
+    area_max_m2: Optional[float] = None
+    dormitorios_min: Optional[int] = None
+    dormitorios_max: Optional[int] = None
+    banos_min: Optional[float] = None
+    banos_max: Optional[float] = None
+    cocheras_min: Optional[int] = None
+    ascensor: Optional[bool] = None
+    terraza: Optional[bool] = None
+    amoblado: Optional[bool] = None
+    pet_friendly: Optional[bool] = None
+
+_RAW_FIELDS = tuple(f.name for f in fields(_ConsultaRaw))
+
 class BuscarRequest(BaseModel):
     query: Optional[str] = None
     filtros: Optional[ConsultaEstructurada] = None
+    limit: int = Field(50, ge=1, description="Máximo de resultados (los más baratos)")
 
 # -----------------------------
 # 3) Parsers sencillos (regex + listas)
@@ -132,6 +163,35 @@ _banos_pattern = re.compile(r"(\d+(?:\.5)?)\s*(baño|banos|baños)", re.IGNORECA
 
 OPERACIONES = {"venta", "alquiler", "alquilo", "alquilar", "compro", "comprar", "vendo"}
 
+# Todas las claves de distrito en una sola alternancia; las más largas primero para que
+# "san juan de miraflores" gane sobre "miraflores"
+_distrito_pattern = re.compile(
+    r"\b(" + "|".join(re.escape(k) for k in sorted(DISTRITOS_MAP, key=len, reverse=True)) + r")\b"
+)
+_tipo_pattern = re.compile(
+    r"\b(" + "|".join(re.escape(tp) for tp in sorted(TIPOS, key=len, reverse=True)) + r")s?\b"
+)
+
+# Palabras clave sueltas -> (campo, valor); se buscan como subcadena, igual que los `in` previos,
+# pero en un solo barrido del texto
+_KEYWORDS: Dict[str, tuple] = {
+    "alquiler": ("operacion", "alquiler"),
+    "alquilo": ("operacion", "alquiler"),
+    "alquilar": ("operacion", "alquiler"),
+    "venta": ("operacion", "venta"),
+    "comprar": ("operacion", "venta"),
+    "compro": ("operacion", "venta"),
+    "vendo": ("operacion", "venta"),
+    "cochera": ("cocheras_min", 1),
+    "ascensor": ("ascensor", True),
+    "terraza": ("terraza", True),
+    "amoblado": ("amoblado", True),
+    "pet friendly": ("pet_friendly", True),
+    "pet-friendly": ("pet_friendly", True),
+    "mascotas": ("pet_friendly", True),
+}
+_keyword_pattern = re.compile("|".join(re.escape(k) for k in sorted(_KEYWORDS, key=len, reverse=True)))
+
 
 def _norm_moneda(token: str) -> Optional[str]:
     t = token.lower()
@@ -144,26 +204,54 @@ def _to_float(num_str: str) -> float:
     return float(num_str.replace(".", "").replace(",", "."))
 
 
-def parse_query_to_filters(texto: str) -> ConsultaEstructurada:
+# Cache del parser por texto en minúsculas. cachetools (y no lru_cache) para poder consultarla
+# desde tiene_distrito; con lock porque /buscar corre en el threadpool.
+_PARSE_CACHE: "LRUCache[str, _ConsultaRaw]" = LRUCache(maxsize=4096)
+_PARSE_LOCK = threading.RLock()
+
+
+def tiene_distrito(texto: str) -> bool:
+    """Prefiltro barato: ¿menciona algún distrito? Un solo regex frente a los ~8 del parser;
+    si el texto ya está en la cache del parser, ni eso."""
     t = texto.lower()
-    result = ConsultaEstructurada()
+    with _PARSE_LOCK:
+        raw = _PARSE_CACHE.get(t)
+    if raw is not None:
+        return bool(raw.distritos)
+    return _distrito_pattern.search(t) is not None
+
+
+def parse_query_to_filters(texto: str) -> ConsultaEstructurada:
+    raw = _parse_cached(texto.lower())
+    data = {name: getattr(raw, name) for name in _RAW_FIELDS}
+    # Listas propias para que quien modifique la consulta no ensucie la cache
+    data["distritos"] = list(raw.distritos)
+    if raw.tipo is not None:
+        data["tipo"] = list(raw.tipo)
+    # model_construct: sin validación, los tipos los controla el propio parser
+    return ConsultaEstructurada.model_construct(**data)
+
+
+@cached(_PARSE_CACHE, key=lambda t: t, lock=_PARSE_LOCK)
+def _parse_cached(t: str) -> _ConsultaRaw:
+    """Parser puro sobre el texto ya en minúsculas; reintentos/mensajes repetidos no re-ejecutan los regex."""
+    result = _ConsultaRaw()
+
+    claves = {_KEYWORDS[k] for k in _keyword_pattern.findall(t)}
 
-    # Operación
-    if any(op in t for op in ["alquiler", "alquilo", "alquilar"]):
+    # Operación (alquiler manda si aparecen ambas)
+    if ("operacion", "alquiler") in claves:
         result.operacion = "alquiler"
-    elif any(op in t for op in ["venta", "comprar", "compro", "vendo"]):
+    elif ("operacion", "venta") in claves:
         result.operacion = "venta"
 
     # Distritos (multi)
-    distritos_detectados = []
-    for key, canon in DISTRITOS_MAP.items():
-        if re.search(rf"\b{re.escape(key)}\b", t):
-            distritos_detectados.append(canon)
-    # Unificar y ordenar
-    result.distritos = sorted(list(dict.fromkeys(distritos_detectados)))
+    distritos_detectados = [DISTRITOS_MAP[k] for k in _distrito_pattern.findall(t)]
+    # Unificar (orden de aparición en el texto)
+    result.distritos = list(dict.fromkeys(distritos_detectados))
 
     # Tipo(s)
-    tipos_detect = [tp for tp in TIPOS if re.search(rf"\b{re.escape(tp)}s?\b", t)]
+    tipos_detect = _tipo_pattern.findall(t)
     if tipos_detect:
         # Normalizar dúplex/duplex
         tipos_norm = ["dúplex" if tp in {"dúplex", "duplex"} else tp for tp in tipos_detect]
@@ -214,11 +302,9 @@ def parse_query_to_filters(texto: str) -> ConsultaEstructurada:
             pass
 
     # Amenidades
-    if "cochera" in t: result.cocheras_min = 1
-    if "ascensor" in t: result.ascensor = True
-    if "terraza" in t: result.terraza = True
-    if "amoblado" in t: result.amoblado = True
-    if "pet friendly" in t or "pet-friendly" in t or "mascotas" in t: result.pet_friendly = True
+    for campo, valor in claves:
+        if campo != "operacion":
+            setattr(result, campo, valor)
 
     return result
 
@@ -280,6 +366,24 @@ MOCK_DATA: List[Dict[str, Any]] = [
     }
 ]
 
+# Índice distrito -> posiciones en MOCK_DATA: cada consulta solo recorre sus distritos
+_IDX_POR_DISTRITO: Dict[str, List[int]] = {}
+for _i, _p in enumerate(MOCK_DATA):
+    _IDX_POR_DISTRITO.setdefault(_p["distrito"], []).append(_i)
+
+# Amenidades bool como bits: un AND + comparación en vez de 4 ramas por fila
+_AMENIDAD_BITS = (("ascensor", 1), ("terraza", 2), ("amoblado", 4), ("pet_friendly", 8))
+# Máscara por fila, en paralelo a MOCK_DATA (no se agrega a los avisos que devuelve /buscar)
+def _mascara_fila(prop: Dict[str, Any]) -> int:
+    return sum(bit for campo, bit in _AMENIDAD_BITS if prop.get(campo) is True)
+
+
+def _mascara_consulta(c: "ConsultaEstructurada") -> int:
+    return sum(bit for campo, bit in _AMENIDAD_BITS if getattr(c, campo) is True)
+
+
+_AMEN_MASK: List[int] = [_mascara_fila(p) for p in MOCK_DATA]
+
 # -----------------------------
 # 5) Endpoints
 # -----------------------------
@@ -289,21 +393,21 @@ def nlu_parse(req: NLURequest) -> ConsultaEstructurada:
     return parsed
 
 
+_EXTRA_FIELDS = ("tipo", "precio_min", "precio_max", "area_min_m2", "area_max_m2",
+                 "dormitorios_min", "dormitorios_max", "banos_min", "banos_max",
+                 "cocheras_min", "ascensor", "terraza", "amoblado", "pet_friendly",
+                 "operacion")
+
+
 def _is_valid_consulta(c: ConsultaEstructurada) -> bool:
     # Regla: distritos obligatorios + al menos otro filtro
     if not c.distritos:
         return False
-    extra = [c.tipo, c.precio_min, c.precio_max, c.area_min_m2, c.area_max_m2,
-             c.dormitorios_min, c.dormitorios_max, c.banos_min, c.banos_max,
-             c.cocheras_min, c.ascensor, c.terraza, c.amoblado, c.pet_friendly,
-             c.operacion]
-    return any(v not in (None, [], "") for v in extra)
+    return any(getattr(c, f) not in (None, [], "") for f in _EXTRA_FIELDS)
 
 
-def _match(prop: Dict[str, Any], c: ConsultaEstructurada) -> bool:
-    # distrito
-    if prop.get("distrito") not in c.distritos:
-        return False
+def _match_campos(prop: Dict[str, Any], c: ConsultaEstructurada) -> bool:
+    """Filtros por fila salvo distrito y amenidades bool, que _filtrar resuelve con el índice y _AMEN_MASK."""
     # operacion
     if c.operacion and prop.get("operacion") != c.operacion:
         return False
@@ -324,14 +428,20 @@ def _match(prop: Dict[str, Any], c: ConsultaEstructurada) -> bool:
     if c.dormitorios_min and (prop.get("dormitorios") or 0) < c.dormitorios_min: return False
     if c.banos_min and (prop.get("banos") or 0) < c.banos_min: return False
     if c.cocheras_min and (prop.get("cocheras") or 0) < c.cocheras_min: return False
-    # amenidades bool
-    if c.ascensor is True and prop.get("ascensor") is not True: return False
-    if c.terraza is True and prop.get("terraza") is not True: return False
-    if c.amoblado is True and prop.get("amoblado") is not True: return False
-    if c.pet_friendly is True and prop.get("pet_friendly") is not True: return False
     return True
 
 
+def _precio_key(prop: Dict[str, Any]) -> float:
+    return prop.get("precio") or 0
+
+
+def _filtrar(c: ConsultaEstructurada) -> List[Dict[str, Any]]:
+    # posiciones ordenadas: mismo orden que recorrer MOCK_DATA completo
+    idx = sorted(i for d in set(c.distritos) for i in _IDX_POR_DISTRITO.get(d, ()))
+    req = _mascara_consulta(c)
+    return [MOCK_DATA[i] for i in idx if _AMEN_MASK[i] & req == req and _match_campos(MOCK_DATA[i], c)]
+
+
 @app.post("/buscar")
 def buscar(req: BuscarRequest) -> Dict[str, Any]:
     # Construir consulta
@@ -347,15 +457,13 @@ def buscar(req: BuscarRequest) -> Dict[str, Any]:
         raise HTTPException(status_code=400, detail="La consulta debe incluir al menos un distrito y un parámetro adicional (tipo, precio, m², dormitorios/baños, amenidades o operación).")
 
     # Filtrar mock
-    matches = [p for p in MOCK_DATA if _match(p, consulta)]
-
-    # Orden simple (precio asc + preferir más recientes en futuro)
-    matches.sort(key=lambda x: (x.get("precio") or 0))
+    matches = _filtrar(consulta)
 
     return {
-        "query_struct": consulta.dict(),
+        "query_struct": consulta.model_dump(exclude_none=True),
         "total": len(matches),
-        "results": matches
+        # Orden simple (precio asc + preferir más recientes en futuro); solo los `limit` primeros
+        "results": heapq.nsmallest(req.limit, matches, key=_precio_key)
     }
 
 
@@ -364,46 +472,13 @@ def root():
     return {"ok": True, "service": "MK Finder MVP"}
 
 # ==============================
-# NUEVOS MÓDULOS PARA Railway + NocoDB + Telegram
+# MÓDULOS PARA Railway + NocoDB + Telegram
 # ==============================
-
-# requirements.txt
-# -----------------
-# Copia este contenido en un archivo llamado requirements.txt
-# y en Railway configura el deploy con este archivo.
-
-fastapi==0.115.0
-uvicorn==0.30.6
-pydantic==2.9.2
-httpx==0.27.2
-python-dotenv==1.0.1
-
-# (Opcional si luego añadimos ASR/NLP avanzado):
-# openai, spacy, torch, whisper, meilisearch
-
-
-# railway.json (opcional)
-# -----------------------
-# Si usas templates en Railway, este archivo ayuda a detectar el servicio web.
-{
-  "build": {
-    "builder": "NIXPACKS",
-    "nixpacksPlan": {
-      "phases": {
-        "setup": {
-          "nixPkgs": ["python311"]
-        },
-        "install": {
-          "cmds": ["pip install -r requirements.txt"]
-        },
-        "start": {
-          "cmd": "uvicorn main:app --host 0.0.0.0 --port ${PORT:-8000}"
-        }
-      }
-    }
-  }
-}
-
+# Viven en sus propios archivos (no duplicarlos aquí):
+# - requirements.txt, railway.json, Dockerfile
+# - nocodb_client.py     -> noco_upsert_props()
+# - telegram_webhook.py  -> router /bot/telegram/webhook
+# - adapters/            -> UrbaniaAdapter (httpx) y UrbaniaPlayAdapter (Playwright)
 
 # .env (variables en Railway → Variables de Entorno)
 # --------------------------------------------------
@@ -417,124 +492,11 @@ python-dotenv==1.0.1
 # NOCO_TABLE=<slug o id de tabla>
 
 
-# services/nocodb_client.py
-# -------------------------
-# Cliente simple para insertar/actualizar propiedades en NocoDB.
-
-import os
-import httpx
-from typing import Dict, Any, List, Optional
-
-NOCO_API_URL = os.getenv("NOCO_API_URL")
-NOCO_TOKEN = os.getenv("NOCO_TOKEN")
-NOCO_DB = os.getenv("NOCO_DB")
-NOCO_TABLE = os.getenv("NOCO_TABLE")
-
-_headers = {}
-if NOCO_TOKEN:
-    _headers["xc-token"] = NOCO_TOKEN
-
-async def noco_upsert_props(items: List[Dict[str, Any]], id_field: str = "id_fuente") -> Dict[str, Any]:
-    """Upsert por id_fuente usando NocoDB REST: /api/v2/tables/{table}/records
-    Requiere que la tabla tenga una columna única para id_fuente o que validemos manual.
-    """
-    if not (NOCO_API_URL and NOCO_DB and NOCO_TABLE):
-        return {"ok": False, "reason": "NOCO_* env vars missing"}
-
-    # Endpoint genérico v2: /api/v2/tables/{table}/records
-    url = f"{NOCO_API_URL}/api/v2/tables/{NOCO_TABLE}/records"
-
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        results = []
-        for it in items:
-            # Intento de encontrar registro existente por id_fuente
-            q = {
-                "where": f"({id_field},eq,{it.get(id_field)})",
-                "limit": 1
-            }
-            r = await client.get(url, headers=_headers, params=q)
-            r.raise_for_status()
-            data = r.json()
-            if data.get("list"):
-                rec_id = data["list"][0]["Id"]
-                upd = await client.patch(f"{url}/{rec_id}", headers=_headers, json={"data": it})
-                upd.raise_for_status()
-                results.append({"action": "update", "id": rec_id})
-            else:
-                ins = await client.post(url, headers=_headers, json={"data": it})
-                ins.raise_for_status()
-                results.append({"action": "insert", "id": ins.json().get("Id")})
-        return {"ok": True, "results": results}
-
-
-# bot/telegram_webhook.py
-# -----------------------
-# Webhook muy simple usando FastAPI (no usa python-telegram-bot para mantenerlo ligero).
-
-import os
-import httpx
-from typing import Dict, Any
-from fastapi import APIRouter, Request, HTTPException
-from main import parse_query_to_filters, _is_valid_consulta, _match, MOCK_DATA
-
-router = APIRouter(prefix="/bot/telegram", tags=["telegram"])
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-BOT_WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET", "")
-
-async def _send_message(chat_id: int, text: str) -> None:
-    if not TELEGRAM_BOT_TOKEN:
-        return
-    api = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    async with httpx.AsyncClient(timeout=15.0) as client:
-        await client.post(api, json={"chat_id": chat_id, "text": text, "parse_mode": "HTML"})
-
-@router.post("/webhook")
-async def tg_webhook(request: Request):
-    # Seguridad simple por header opcional
-    secret = request.headers.get("X-Tg-Secret", "")
-    if BOT_WEBHOOK_SECRET and secret != BOT_WEBHOOK_SECRET:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-
-    payload: Dict[str, Any] = await request.json()
-    message = payload.get("message") or payload.get("edited_message")
-    if not message:
-        return {"ok": True}
-
-    chat_id = message["chat"]["id"]
-    text = (message.get("text") or "").strip()
-
-    if not text:
-        await _send_message(chat_id, "Envíame lo que buscas. Ej: ‘Venta en Miraflores y San Isidro, 2 dorm, hasta 250k usd, con ascensor’.")
-        return {"ok": True}
-
-    # Parseo y búsqueda sobre MOCK (luego conectamos fuentes reales)
-    consulta = parse_query_to_filters(text)
-    if not _is_valid_consulta(consulta):
-        await _send_message(chat_id, "Necesito al menos un distrito y un parámetro extra (tipo, precio, m², dormitorios/baños o amenidades).")
-        return {"ok": True}
-
-    matches = [p for p in MOCK_DATA if _match(p, consulta)]
-    if not matches:
-        await _send_message(chat_id, "No encontré coincidencias en el demo. Ajusta filtros o prueba otro distrito.")
-        return {"ok": True}
-
-    # Render simple (máx 5 resultados)
-    lines = [f"<b>{m['titulo']}</b>
-{m['operacion'].title()} · {m['tipo']} · {m['distrito']}
-{m['moneda']} {m['precio']:,}
-{m['url_aviso']}" for m in matches[:5]]
-    await _send_message(chat_id, "
-
-".join(lines))
-    return {"ok": True}
-
-
 # main.py (ADDENDUM)
 # ------------------
-# Agrega al final de tu main.py la inclusión del router de Telegram y un ping de salud.
+# Inclusión del router de Telegram y un ping de salud (al final: el router importa de este módulo).
 
-from fastapi import APIRouter
-from bot.telegram_webhook import router as tg_router
+from telegram_webhook import router as tg_router
 
 app.include_router(tg_router)
 
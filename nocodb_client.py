@@ -1,6 +1,8 @@
+import asyncio
 import os
 import httpx
-from typing import Dict, Any, List
+import orjson
+from typing import Dict, Any, List, Optional, Tuple
 
 NOCO_API_URL = os.getenv("NOCO_API_URL")
 NOCO_TOKEN = os.getenv("NOCO_TOKEN")
@@ -11,27 +13,117 @@ _headers = {}
 if NOCO_TOKEN:
     _headers["xc-token"] = NOCO_TOKEN
 
+# Cliente compartido entre upserts: reutiliza conexiones y TLS con NocoDB
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=30.0,
+            headers=_headers,
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=8, max_connections=16),
+        )
+    return _client
+
+
+async def noco_aclose() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+# NocoDB v2 acepta arrays en POST/PATCH /records; 100 registros por lote
+_BULK_SIZE = 100
+# Lotes en paralelo, acotado: cada uno ya mueve 100 registros
+_BULK_CONCURRENCY = 4
+
+
+# Registro a escribir: (clave normalizada o None si no trae id, datos)
+_Registro = Tuple[Optional[str], Dict[str, Any]]
+
+
+async def _upsert_chunk(client: httpx.AsyncClient, url: str, chunk: List[_Registro], id_field: str) -> List[Tuple[bool, Any]]:
+    """Escribe un lote de registros ya únicos; devuelve (existía, Id) alineado con `chunk`."""
+    keys = [k for k, _ in chunk if k is not None]
+    existing: Dict[str, Any] = {}
+    if keys:
+        q = {
+            "where": f"({id_field},in,{','.join(keys)})",
+            "limit": len(keys),
+            "fields": f"Id,{id_field}",
+        }
+        r = await client.get(url, params=q)
+        r.raise_for_status()
+        existing = {str(row[id_field]): row["Id"] for row in orjson.loads(r.content).get("list", [])}
+
+    to_update = [{**data, "Id": existing[k]} for k, data in chunk if k in existing]
+    to_insert = [data for k, data in chunk if k not in existing]
+
+    if to_update:
+        upd = await client.patch(url, json=to_update)
+        upd.raise_for_status()
+    new_ids: List[Any] = []
+    if to_insert:
+        ins = await client.post(url, json=to_insert)
+        ins.raise_for_status()
+        # la respuesta bulk viene en el mismo orden que el array enviado
+        new_ids = [row.get("Id") for row in orjson.loads(ins.content)]
+
+    new_iter = iter(new_ids)
+    return [(True, existing[k]) if k in existing else (False, next(new_iter, None)) for k, _ in chunk]
+
+
 async def noco_upsert_props(items: List[Dict[str, Any]], id_field: str = "id_fuente") -> Dict[str, Any]:
-    """Upsert simple por id_fuente usando NocoDB REST v2 tables endpoint"""
+    """Upsert por id_fuente usando los endpoints bulk de NocoDB REST v2 (3 requests por lote de 100)"""
     if not (NOCO_API_URL and NOCO_DB and NOCO_TABLE):
         return {"ok": False, "reason": "NOCO_* env vars missing"}
 
     url = f"{NOCO_API_URL}/api/v2/tables/{NOCO_TABLE}/records"
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        results = []
-        for it in items:
-            q = {"where": f"({id_field},eq,{it.get(id_field)})", "limit": 1}
-            r = await client.get(url, headers=_headers, params=q)
-            r.raise_for_status()
-            data = r.json()
-            if data.get("list"):
-                rec_id = data["list"][0]["Id"]
-                upd = await client.patch(f"{url}/{rec_id}", headers=_headers, json={"data": it})
-                upd.raise_for_status()
-                results.append({"action": "update", "id": rec_id})
-            else:
-                ins = await client.post(url, headers=_headers, json={"data": it})
-                ins.raise_for_status()
-                results.append({"action": "insert", "id": ins.json().get("Id")})
-        return {"ok": True, "results": results}
+    # Ids repetidos se fusionan en TODA la entrada antes de partir en lotes: dos lotes en
+    # paralelo no ven los inserts del otro y duplicarían el registro.
+    # Claves como str: NocoDB devuelve el valor guardado ("7") aunque el item traiga 7.
+    by_id: Dict[str, Dict[str, Any]] = {}
+    sin_id: List[Dict[str, Any]] = []
+    for it in items:
+        key = it.get(id_field)
+        if key is None:
+            sin_id.append(it)
+        else:
+            k = str(key)
+            by_id[k] = {**by_id[k], **it} if k in by_id else it
+    registros: List[_Registro] = [(k, data) for k, data in by_id.items()] + [(None, it) for it in sin_id]
+
+    sem = asyncio.Semaphore(_BULK_CONCURRENCY)
+
+    async def one(chunk: List[_Registro]) -> List[Tuple[bool, Any]]:
+        async with sem:
+            return await _upsert_chunk(client, url, chunk, id_field)
+
+    client = _get_client()
+    chunks = [registros[i:i + _BULK_SIZE] for i in range(0, len(registros), _BULK_SIZE)]
+    # gather conserva el orden de los lotes, así que queda alineado con `registros`
+    per_chunk = await asyncio.gather(*(one(c) for c in chunks))
+    escritos = [res for rs in per_chunk for res in rs]
+    por_clave = {k: escritos[i] for i, (k, _) in enumerate(registros) if k is not None}
+    sin_id_iter = iter(escritos[len(by_id):])
+
+    # Un resultado por item y en el orden de entrada, como el upsert item a item:
+    # un id repetido cuenta como update desde su segunda aparición
+    results: List[Dict[str, Any]] = []
+    vistos = set()
+    for it in items:
+        key = it.get(id_field)
+        if key is None:
+            _, rec_id = next(sin_id_iter)
+            results.append({"action": "insert", "id": rec_id})
+            continue
+        k = str(key)
+        existia, rec_id = por_clave[k]
+        results.append({"action": "update" if existia or k in vistos else "insert", "id": rec_id})
+        vistos.add(k)
+    return {"ok": True, "results": results}
@@ -1,43 +1,105 @@
+import heapq
 import os
 import httpx
+import orjson
+from collections import OrderedDict, defaultdict
 from typing import Dict, Any
-from fastapi import APIRouter, Request, HTTPException
-from main import parse_query_to_filters, _is_valid_consulta, _match, MOCK_DATA
+from fastapi import APIRouter, Request, HTTPException, Response
+from main import parse_query_to_filters, tiene_distrito, _is_valid_consulta, _filtrar, _precio_key
 
 router = APIRouter(prefix="/bot/telegram", tags=["telegram"])
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
+# update_id ya atendidos: Telegram reentrega el mismo update si respondemos lento o con error.
+# Es por proceso: con WEB_CONCURRENCY > 1 un reintento que cae en otro worker no se detecta
+# (para eso haría falta un store compartido, p. ej. Redis).
+_SEEN_UPDATES: "OrderedDict[int, None]" = OrderedDict()
+_SEEN_MAX = 4096
+
+# Respuesta ya serializada: Telegram solo mira el status, no hace falta codificar un dict por update
+_OK = Response(content=b'{"ok":true}', media_type="application/json")
+
+# Plantilla de cada resultado, parseada una sola vez
+_RESULT_TPL = "<b>{titulo}</b>\n{operacion_t} · {tipo} · {distrito}\n{moneda} {precio:,}\n{url_aviso}".format_map
+_OPERACION_TITULO = {"venta": "Venta", "alquiler": "Alquiler"}
+_MSG_FALTAN_FILTROS = "Necesito al menos un distrito y un parámetro extra (tipo, precio, m², dormitorios/baños o amenidades)."
+
+# Cliente persistente: evita un handshake TCP+TLS con api.telegram.org por mensaje
+_tg_client = httpx.AsyncClient(
+    base_url=f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}",
+    timeout=15.0,
+    http2=True,
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=120.0),
+)
+
+
+@router.on_event("shutdown")
+async def _close_tg_client() -> None:
+    await _tg_client.aclose()
+
+
+def _render(m: Dict[str, Any]) -> str:
+    row = defaultdict(str, m)
+    op = row["operacion"]
+    row["operacion_t"] = _OPERACION_TITULO.get(op) or op.title()
+    return _RESULT_TPL(row)
+
+
 async def _send_message(chat_id: int, text: str) -> None:
     if not TELEGRAM_BOT_TOKEN:
         return
-    api = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    async with httpx.AsyncClient(timeout=15.0) as client:
-        await client.post(api, json={"chat_id": chat_id, "text": text, "parse_mode": "HTML"})
+    await _tg_client.post(
+        "/sendMessage",
+        content=orjson.dumps({"chat_id": chat_id, "text": text, "parse_mode": "HTML"}),
+        headers={"Content-Type": "application/json"},
+    )
 
 @router.post("/webhook")
 async def tg_webhook(request: Request):
-    payload: Dict[str, Any] = await request.json()
+    payload: Dict[str, Any] = orjson.loads(await request.body())
+    uid = payload.get("update_id")
+    if uid is not None:
+        if uid in _SEEN_UPDATES:
+            return _OK
+        _SEEN_UPDATES[uid] = None
+        if len(_SEEN_UPDATES) > _SEEN_MAX:
+            _SEEN_UPDATES.popitem(last=False)
+
+    try:
+        return await _procesar(payload)
+    except Exception:
+        # Falló antes de responder al usuario: olvidamos el update para que el reintento de Telegram entre
+        if uid is not None:
+            _SEEN_UPDATES.pop(uid, None)
+        raise
+
+
+async def _procesar(payload: Dict[str, Any]) -> Response:
     message = payload.get("message") or payload.get("edited_message")
     if not message:
-        return {"ok": True}
+        return _OK
 
     chat_id = message["chat"]["id"]
     text = (message.get("text") or "").strip()
 
     if not text:
         await _send_message(chat_id, "Envíame lo que buscas. Ej: ‘Venta en Miraflores y San Isidro, 2 dorm, hasta 250k usd, con ascensor’.")
-        return {"ok": True}
+        return _OK
+
+    # Saludos/ruido sin distrito: respondemos sin correr el parser completo
+    if not tiene_distrito(text):
+        await _send_message(chat_id, _MSG_FALTAN_FILTROS)
+        return _OK
 
     consulta = parse_query_to_filters(text)
     if not _is_valid_consulta(consulta):
-        await _send_message(chat_id, "Necesito al menos un distrito y un parámetro extra (tipo, precio, m², dormitorios/baños o amenidades).")
-        return {"ok": True}
+        await _send_message(chat_id, _MSG_FALTAN_FILTROS)
+        return _OK
 
-    matches = [p for p in MOCK_DATA if _match(p, consulta)]
+    matches = _filtrar(consulta)
     if not matches:
         await _send_message(chat_id, "No encontré coincidencias en el demo. Ajusta filtros o prueba otro distrito.")
-        return {"ok": True}
+        return _OK
 
-    lines = [f"<b>{m['titulo']}</b>\n{m['operacion'].title()} · {m['tipo']} · {m['distrito']}\n{m['moneda']} {m['precio']:,}\n{m['url_aviso']}" for m in matches[:5]]
-    await _send_message(chat_id, "\n\n".join(lines))
-    return {"ok": True}
+    await _send_message(chat_id, "\n\n".join(_render(m) for m in heapq.nsmallest(5, matches, key=_precio_key)))
+    return _OK